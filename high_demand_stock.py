@@ -1,9 +1,12 @@
-import io
-import re
+import sys
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import cached_property
 from typing import Set, Dict
 import boto3
 from botocore.config import Config
+from botocore.response import StreamingBody
+import numpy as np
 import pandas as pd
 from apps.brand.enums import SubscriptionType
 from apps.product_v2.models.product import Product
@@ -14,7 +17,7 @@ from django.utils import timezone
 from django.core.mail import EmailMessage
 from django.conf import settings
 from django.template.loader import render_to_string
-from django.db.models import Q
+from django.db import connection, transaction
 from utils.date import start_of_today, last_n_weeks_from_now, last_n_months_from_now
 from utils.athena.query_execution import execute_athena_query
 from utils.pandas.export_dataframe import ExportDataframeWrapper
@@ -25,30 +28,32 @@ from tqdm import tqdm
 class StockDataframeWrapper():
     def __init__(self, df: pd.DataFrame):
         self.df = df
+        self.mask = np.ones(len(df), dtype=bool)  # apply 호출 시 한 번에 적용할 필터 조건
+        self.sort_by = None
         
     def filter_idle_stock(self, in_stock_count: int):
         """유휴재고 in_stock_count개 이하"""
-        self.df = self.df.loc[self.df["current_in_stock_count"]<=in_stock_count]
+        self.mask &= (self.df["current_in_stock_count"]<=in_stock_count).to_numpy()
         return self
     
     def filter_view_count(self, view_count: int):
         """1주일간 조회수 view_count개 이상"""
-        self.df = self.df.loc[self.df["view_count"]>view_count]
+        self.mask &= (self.df["view_count"]>view_count).to_numpy()
         return self
         
     def filter_like_count(self, like_count: int):
         """전체 like 수 like_count개 이상"""      
-        self.df = self.df.loc[self.df["accumulative_product_like_count"]>like_count]
+        self.mask &= (self.df["accumulative_product_like_count"]>like_count).to_numpy()
         return self
     
     def filter_last_tryset_time(self, last_tryset_item_created_time: str):
         """마지막 tryset 이용 날짜 last_tryset_item_created_time 이내"""
-        self.df = self.df.loc[self.df["latest_tryset_item_created_time"]>last_tryset_item_created_time]
+        self.mask &= (self.df["latest_tryset_item_created_time"]>last_tryset_item_created_time).to_numpy()
         return self    
     
     def filter_adequate_stock_count(self):
         """적정 재고수 보다 현재 재고 수가 적은 숫자"""
-        self.df = self.df.loc[self.df["adquate_stock_count"]>self.df["stock_count"]]
+        self.mask &= (self.df["adquate_stock_count"]>self.df["stock_count"]).to_numpy()
         return self
         
     def filter_look_upload_rate(
@@ -58,7 +63,7 @@ class StockDataframeWrapper():
         first_in_stock_time: str
     ):
         """(재고 입고일 이후 3달 이상 && 게시율 40% 이상) OR 재고 입고일 이후 1주일 이상"""
-        self.df = self.df.loc[
+        self.mask &= (
             (self.df['first_in_stock_time']!=None) 
             & (
                 (
@@ -70,11 +75,23 @@ class StockDataframeWrapper():
                     & (self.df['first_in_stock_time']>look_upload_rate_over_time)    
                 )
             )
-        ]
+        ).to_numpy()
         return self
         
     def sort(self, key: str, ascending: bool):
-        self.df = self.df.sort_values(by=[key], ascending=ascending)
+        self.sort_by = (key, ascending)
+        return self
+        
+    def apply(self):
+        """쌓아둔 필터 조건을 한 번에 적용한 뒤 정렬"""
+        df = self.df.loc[self.mask]
+        if self.sort_by is not None:
+            key, ascending = self.sort_by
+            df = df.sort_values(by=[key], ascending=ascending)
+        self.df = df
+        self.mask = np.ones(len(df), dtype=bool)
+        self.sort_by = None
+        return self
         
 
 class HighDemandStockFilter():
@@ -83,45 +100,75 @@ class HighDemandStockFilter():
     LIKE_COUNT=15
     ADEQUATE_STOCK_COUNT=[15,10,5]
     LOOK_POST_RATE=40.0
+    # HIGH_DEMAND_STOCK 결과 중 필터/메일에 사용하는 컬럼
+    SOURCE_COLUMNS=[
+        "product_id",
+        "product_name",
+        "brand_id",
+        "brand_name",
+        "manager_page_url",
+        "stock_count",
+        "current_in_stock_count",
+        "current_in_use_count",
+        "accumulative_product_like_count",
+        "view_count",
+        "look_count",
+        "tryset_item_count",
+        "latest_tryset_item_created_time",
+        "first_in_stock_time",
+    ]
+    # get_filtered_items 결과 컬럼 { "원본 컬럼": "결과 컬럼" }
+    FILTERED_COLUMNS={
+        "product_id": "product_id",
+        "product_name": "상품명",
+        "brand_id": "brand_id",
+        "brand_name": "브랜드",
+        "manager_page_url": "매니저 페이지 링크",
+        "adquate_stock_count": "적정 재고수",
+        "current_in_stock_count": "입고중 재고",
+        "current_in_use_count": "이용중 재고",
+        "accumulative_product_like_count": "누적 좋아요 수",
+        "view_count": "1주일간 조회수",
+        "requested_mail": "3주내 요청이력",
+        "first_in_stock_time": "재고 입고일",
+    }
     
     def __init__(self, dataframe: pd.DataFrame):
-        self.dataframe = dataframe.copy()
+        self.dataframe = dataframe.copy(deep=False)  # 파생 컬럼만 추가하므로 데이터는 복사하지 않음
         self.LAST_TRYSET_ITEM_CREATED_TIME = ""
         self.COLD_START_PRODUCT_TIME = ""
         self.sent_mail_product = set()
 
-    def __check_product_requested(self, row) -> bool:
-        return int(row["product_id"]) in self.sent_mail_product
-
-    def __set_adequate_stock_count(self, row) -> int:
-        """적정 재고수
-        
-        15개: 1주일간 조회수 100 이상
-        
-        10개: 1주일간 조회수 50이상 100미만, 누적 좋아요 수 20이상
-        
-        5개: 나머지
-        """
-        if row["view_count"] > 100:
-            return self.ADEQUATE_STOCK_COUNT[0]
-        elif row["view_count"] > 50 and row["accumulative_product_like_count"] > 20:
-            return self.ADEQUATE_STOCK_COUNT[1]
-        else:
-            return self.ADEQUATE_STOCK_COUNT[2]
-        
-    def __set_look_post_rate(self, row) -> float:
-        return (row["look_count"] / row["tryset_item_count"]) * 100
-        
     def filter_high_demand_stock(self):
         self.LAST_TRYSET_ITEM_CREATED_TIME = str(last_n_months_from_now(n=1))
         self.COLD_START_PRODUCT_TIME= str(last_n_months_from_now(n=3))
         self.FIRST_IN_STOCK_TIME = str(last_n_weeks_from_now(n=1))
         
         self.sent_mail_product = set(StockExtraInStockRequest.objects \
-            .values_list("product", flat=True).distinct("product"))
-        self.dataframe["adquate_stock_count"] = self.dataframe.apply(lambda row: self.__set_adequate_stock_count(row), axis=1)
-        self.dataframe["requested_mail"] = self.dataframe.apply(lambda row: self.__check_product_requested(row), axis=1)
-        self.dataframe["look_post_rate"] = self.dataframe.apply(lambda row: self.__set_look_post_rate(row), axis=1)
+            .values_list("product_id", flat=True).distinct())
+        # 적정 재고수
+        # 15개: 1주일간 조회수 100 이상
+        # 10개: 1주일간 조회수 50이상 100미만, 누적 좋아요 수 20이상
+        # 5개: 나머지
+        view_count = self.dataframe["view_count"].to_numpy()
+        like_count = self.dataframe["accumulative_product_like_count"].to_numpy()
+        self.dataframe["adquate_stock_count"] = np.select(
+            [view_count > 100, (view_count > 50) & (like_count > 20)],
+            self.ADEQUATE_STOCK_COUNT[:2],
+            default=self.ADEQUATE_STOCK_COUNT[2],
+        )
+        self.dataframe["requested_mail"] = self.dataframe["product_id"].astype("int64").isin(
+            np.fromiter(self.sent_mail_product, dtype="int64", count=len(self.sent_mail_product))
+        )
+        # tryset 이용 이력이 없는 상품은 게시율 0%
+        look_count = self.dataframe["look_count"].to_numpy()
+        tryset_item_count = self.dataframe["tryset_item_count"].to_numpy()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.dataframe["look_post_rate"] = np.where(
+                tryset_item_count == 0,
+                0.0,
+                look_count / tryset_item_count * 100.0,
+            )
         
         stock_data = StockDataframeWrapper(df=self.dataframe)
         stock_data.filter_idle_stock(self.IN_STOCK_COUNT) \
@@ -130,36 +177,14 @@ class HighDemandStockFilter():
             .filter_last_tryset_time(self.LAST_TRYSET_ITEM_CREATED_TIME) \
             .filter_adequate_stock_count() \
             .filter_look_upload_rate(self.LOOK_POST_RATE, self.COLD_START_PRODUCT_TIME, self.FIRST_IN_STOCK_TIME) \
-            .sort(key="view_count", ascending=False)
+            .sort(key="view_count", ascending=False) \
+            .apply()
         
         self.dataframe = stock_data.df
     
     def get_filtered_items(self) -> pd.DataFrame:
-        return self.dataframe.filter(items=[
-            "product_id",
-            "product_name",
-            "brand_id",
-            "brand_name",
-            "manager_page_url",
-            "adquate_stock_count",
-            "current_in_stock_count",
-            "current_in_use_count",
-            "accumulative_product_like_count",
-            "view_count",
-            "requested_mail",
-            "first_in_stock_time",
-        ]).rename(columns={
-            "product_name": "상품명",
-            "brand_name": "브랜드",
-            "manager_page_url": "매니저 페이지 링크",
-            "adquate_stock_count": "적정 재고수",
-            "current_in_stock_count": "입고중 재고",
-            "current_in_use_count": "이용중 재고",
-            "accumulative_product_like_count": "누적 좋아요 수",
-            "view_count": "1주일간 조회수",
-            "requested_mail": "3주내 요청이력",
-            "first_in_stock_time": "재고 입고일",
-        })
+        return self.dataframe.loc[:, list(self.FILTERED_COLUMNS)] \
+            .rename(columns=self.FILTERED_COLUMNS, copy=False)
 
 
 class HighDemandStockNudge():
@@ -175,29 +200,38 @@ class HighDemandStockNudge():
         """weeks(int)이내에 메일을 보냈던 브랜드를 반환"""
         cycle = last_n_weeks_from_now(n=weeks)
         
-        return set(StockExtraInStockRequest.objects.filter(
-            ~Q(product__brand__subscription_type=SubscriptionType.ENTERPRISE) | 
-            Q(requested_time__gte=cycle),
-        ).values_list("product__brand", flat=True).distinct("product__brand"))
+        recently_requested = StockExtraInStockRequest.objects.filter(
+            requested_time__gte=cycle,
+        ).values_list("product__brand_id", flat=True).distinct()
+        not_enterprise = StockExtraInStockRequest.objects.exclude(
+            product__brand__subscription_type=SubscriptionType.ENTERPRISE,
+        ).values_list("product__brand_id", flat=True).distinct()
+        
+        return set(recently_requested) | set(not_enterprise)
     
     def get_high_demand_product(self) -> Dict[int, pd.DataFrame]:
         """메일 보낼 내용 보관"""
         self.filtered_brands = self.__filter_brands(self.MAIL_CYCLE_WEEKS)
-        grouped_product = self.high_demand_stock.groupby("brand_id")
-        for brand_id, products in grouped_product:
+        not_requested = self.high_demand_stock.loc[self.high_demand_stock["3주내 요청이력"] == False]
+        grouped_indices = not_requested.groupby("brand_id", sort=False).indices
+        for brand_id, indices in grouped_indices.items():
             if int(brand_id) not in self.filtered_brands:
-                self.mail_list[int(brand_id)] = products.loc[products["3주내 요청이력"] == False]
+                self.mail_list[int(brand_id)] = not_requested.take(indices)
 
         return self.mail_list
     
     def save_instock_request(self, df: pd.DataFrame):
+        product_ids = df["product_id"].astype(int).tolist()
+        request_amounts = df["적정 재고수"].astype(int).tolist()
+        products = Product.objects.in_bulk(product_ids)
+        now = timezone.now()
         prepared_instock_request_rows = [
             StockExtraInStockRequest(
-                product=Product.objects.get(id=rows["product_id"]),
+                product=products[product_id],
                 round=0,
-                requested_time=timezone.now(),
-                request_amount=rows["적정 재고수"],
-            ) for _, rows in df.iterrows()
+                requested_time=now,
+                request_amount=request_amount,
+            ) for product_id, request_amount in zip(product_ids, request_amounts)
         ]
         
         StockExtraInStockRequest.objects.bulk_create(prepared_instock_request_rows)
@@ -211,25 +245,42 @@ class TaskStockNudging():
     BUCKET_NAME="high-demand-stock-data"
     ROOT_FOLDER_NAME="high_demand_product"
     DATABASE="amplitude"
+    MAIL_MAX_WORKERS=8
+    # 브랜드 메일 첨부 엑셀 컬럼
+    MAIL_COLUMNS=[
+        "상품명",
+        "브랜드",
+        "매니저 페이지 링크",
+        "적정 재고수",
+        "입고중 재고",
+        "이용중 재고",
+        "누적 좋아요 수",
+        "1주일간 조회수",
+    ]
+    _MAIL_HTML=None  # context 없는 정적 템플릿이라 최초 발송 시 한 번만 렌더링
     
-    def __get_s3_resource(self):
+    @cached_property
+    def s3(self):
         return boto3.resource(
             "s3",
             region_name=self.REGION_NAME,
             config=Config(signature_version="s3v4"),
         )
         
-    def __get_athena_client(self):
+    @cached_property
+    def athena(self):
         return boto3.client("athena", region_name=self.REGION_NAME)
     
     def __get_s3_data(self, bucket_name, file_location):
-        s3 = self.__get_s3_resource()
-        
-        bucket = s3.Bucket(name=bucket_name)
-        return bucket.Object(file_location).get()["Body"].read()
+        bucket = self.s3.Bucket(name=bucket_name)
+        return bucket.Object(file_location).get()["Body"]
     
-    def __read_csv_data(self, data: bytes):
-        return pd.read_csv(io.BytesIO(data))
+    def __read_csv_data(self, data: StreamingBody):
+        # NOTE: pandas does not close file objects it did not open, release the connection back to the pool.
+        try:
+            return pd.read_csv(data, usecols=HighDemandStockFilter.SOURCE_COLUMNS)
+        finally:
+            data.close()
     
     def __prepare_query_paramters(self):
         """
@@ -292,11 +343,12 @@ class TaskStockNudging():
         ]:
             return
         
-        html = render_to_string("stock_nudging_email.html")
+        if TaskStockNudging._MAIL_HTML is None:
+            TaskStockNudging._MAIL_HTML = render_to_string("stock_nudging_email.html")
         
         mail = EmailMessage(
             subject="[브랜더진] 인기재고 추가 입고요청",
-            body=html,
+            body=TaskStockNudging._MAIL_HTML,
             from_email="Brandazine <hello@brandazine.com>",
             to=brand_mails,
         )
@@ -304,13 +356,27 @@ class TaskStockNudging():
         mail.attach(f"{date}_{brand_name}_인기재고.xlsx", product_data, "application/vnd.ms-excel")
         mail.send()
 
+    def __mail_brand(self, date, brand: Brand, products: pd.DataFrame, nudge_data: HighDemandStockNudge):
+        """브랜드 별 인기재고 메일 발송 후 입고요청 저장 (worker thread에서 실행)"""
+        try:
+            data = self.__export_dataframe(products.loc[:, self.MAIL_COLUMNS], True)
+            brand_emails = [admin.email for admin in brand.admins.all()]
+            if brand.business_email:
+                brand_emails.append(brand.business_email)
+            brand_emails.append("thkim@brandazine.com")
+            self.__send_mail(date, brand.name_ko, brand_emails, data)
+            with transaction.atomic():
+                nudge_data.save_instock_request(df=products)
+        finally:
+            # NOTE: Django keeps a DB connection per thread, close it once the brand is done.
+            connection.close()
+
     def handle(self, *args, **options):
-        client = self.__get_athena_client()
         query_parameters = self.__prepare_query_paramters()
         
         try:
             result = execute_athena_query(
-                client=client,
+                client=self.athena,
                 query=HIGH_DEMAND_STOCK,
                 database=self.DATABASE,
                 output_location="s3://"+self.BUCKET_NAME+"/"+self.ROOT_FOLDER_NAME,
@@ -326,7 +392,7 @@ class TaskStockNudging():
             return
 
         s3_path = result['QueryExecution']['ResultConfiguration']['OutputLocation']
-        filename = re.findall('.*\/(.*)', s3_path)[0]
+        filename = s3_path.rsplit("/", 1)[-1]
         file_location = self.ROOT_FOLDER_NAME+"/"+filename
         
         data = self.__get_s3_data(self.BUCKET_NAME, file_location)
@@ -351,35 +417,30 @@ class TaskStockNudging():
         nudge_data = HighDemandStockNudge(df)
         mail_list = nudge_data.get_high_demand_product()
 
-        send_brand_list = Brand.objects.prefetch_related("admins").filter(
-            id__in=mail_list.keys(),
+        send_brand_list = Brand.objects.filter(
+            id__in=list(mail_list),
             subscription_type__in=[SubscriptionType.NORMAL, SubscriptionType.FREE],
-        ).distinct()
+        ).prefetch_related("admins")
         success_emailed_brand, failed_emailed_brand = list(), list()
-        for brand in tqdm(send_brand_list):
-            dataframe = mail_list[brand.id].filter(items=[
-                "상품명",
-                "브랜드",
-                "매니저 페이지 링크",
-                "적정 재고수",
-                "입고중 재고",
-                "이용중 재고",
-                "누적 좋아요 수",
-                "1주일간 조회수",
-            ])
-            try:
-                data = self.__export_dataframe(dataframe, True)
-                brand_emails = list(brand.admins.values_list("email", flat=True))
-                if brand.business_email:
-                    brand_emails.append(brand.business_email)
-                brand_emails.append("thkim@brandazine.com")
-                self.__send_mail(today, brand.name_ko, brand_emails, data)
-                nudge_data.save_instock_request(df=mail_list[brand.id])
-                success_emailed_brand.append(f"{brand.name_ko}")
-            except Exception as error:
-                logger.error(f"Fail to mail[{brand.name_ko}], see error\n{error}")
-                failed_emailed_brand.append(brand.name_ko)
-                continue
+        with ThreadPoolExecutor(max_workers=self.MAIL_MAX_WORKERS) as executor:
+            futures = {
+                executor.submit(self.__mail_brand, today, brand, mail_list[brand.id], nudge_data): brand
+                for brand in send_brand_list
+            }
+            progress = tqdm(
+                as_completed(futures),
+                total=len(futures),
+                mininterval=5.0,
+                disable=not sys.stderr.isatty(),
+            )
+            for future in progress:
+                brand = futures[future]
+                try:
+                    future.result()
+                    success_emailed_brand.append(f"{brand.name_ko}")
+                except Exception as error:
+                    logger.error(f"Fail to mail[{brand.name_ko}], see error\n{error}")
+                    failed_emailed_brand.append(brand.name_ko)
 
         post_message(
             message=(